@@ -19,6 +19,7 @@
 
 import argparse
 import os
+import re
 
 from nsaph import init_logging
 from nsaph.ds import create_datasource_def
@@ -26,6 +27,9 @@ from nsaph.reader import get_entries, get_readme
 from nsaph.data_model.model import Table
 
 
+COLUMN_SPEC = re.compile(r"^([^:]+):([^:]+):(\d+)$")
+
+
 def analyze(path: str, metadata_path: str=None, columns=None, column_map=None):
     entries, open_function = get_entries(path)
     table = Table(data_file=path, get_entry=open_function,
@@ -34,8 +38,11 @@ def analyze(path: str, metadata_path: str=None, columns=None, column_map=None):
     table.analyze(entries[0])
     if columns:
         for c in columns:
-            x = c.split(':')
-            table.add_column(x[0], x[1], int(x[2]))
+            m = COLUMN_SPEC.match(c)
+            if not m:
+                raise ValueError("Invalid column specification: {}, "
+                                 "expected name:type:extraction_method".format(c))
+            table.add_column(m.group(1), m.group(2), int(m.group(3)))
     return table
 
 
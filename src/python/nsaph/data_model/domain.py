@@ -25,9 +25,13 @@ See
 #  limitations under the License.
 #
 
+import copy
 import logging
+import os
 import re
-from typing import Optional, Dict, List
+from collections import OrderedDict
+from functools import partial
+from typing import Optional, Dict, List, Tuple, Callable
 
 from nsaph_utils.utils.io_utils import as_dict
 
@@ -75,6 +79,8 @@ VALIDATION_TRIGGER = """
 """
 
 
+CREATE_TABLE = "CREATE TABLE {flag} {name} (\n\t{features}\n);"
+
 CREATE_VIEW = """
 CREATE {OBJECT} {flag} {name} AS
 SELECT
@@ -87,21 +93,49 @@ WHERE {not_null}
 GROUP BY {id};
 """
 
+SPEC_CACHE_SIZE = 16
+_spec_cache = OrderedDict()
+
+
+def _load_spec_cached(spec) -> dict:
+    """
+    Loads domain specification, reusing the result of previous parsing
+    if the same file has already been loaded and has not been modified
+    since then.
+
+    :param spec: either a path to a YAML or JSON file or
+        an already parsed dictionary
+    :return: a private copy of the parsed specification
+    """
+    if not isinstance(spec, (str, os.PathLike)):
+        return as_dict(spec)
+    path = os.path.abspath(spec)
+    st = os.stat(path)
+    key = (path, st.st_mtime_ns, st.st_size)
+    if key in _spec_cache:
+        _spec_cache.move_to_end(key)
+    else:
+        _spec_cache[key] = as_dict(spec)
+        if len(_spec_cache) > SPEC_CACHE_SIZE:
+            _spec_cache.popitem(last=False)
+    return copy.deepcopy(_spec_cache[key])
+
 
 class Domain:
     CREATE = "CREATE TABLE {flag} {name}"
 
     def __init__(self, spec, name):
         self.domain = name
-        self.spec = as_dict(spec)
+        self.spec = _load_spec_cached(spec)
         if "schema" in self.spec[self.domain]:
             self.schema = self.spec[self.domain]["schema"]
         elif "schema" in self.spec:
             self.schema = self.spec["schema"]
         else:
             self.schema = None
-        self.indices = []
-        self.indices_by_table = dict()
+        self._index_specs: List[Tuple[str, Callable[[], str]]] = []
+        self._indices: Optional[List[str]] = None
+        self._indices_by_table: Optional[Dict[str, List[str]]] = None
         self.ddl_by_table = dict()
         self.common_ddl = []
         self.ddl = []
@@ -116,6 +150,11 @@ class Domain:
         else:
             raise Exception("Invalid indexing policy: " + index_policy)
         self.sloppy = False
+        self._find_cache: Optional[Dict[str, dict]] = None
+        self._match_patterns = dict()
+        self._fqn_cache: Dict[str, str] = dict()
+        self._col_flag_cache: Dict[int, Tuple[dict, bool, bool]] = dict()
+        self._fk_validation_cache: Dict[tuple, Tuple[List[str], List[str]]] = dict()
 
     def set_sloppy(self):
         self.sloppy = True
@@ -127,6 +166,7 @@ class Domain:
         )
 
     def init(self) -> None:
+        self._col_flag_cache = dict()
         if self.schema:
             ddl = "CREATE SCHEMA IF NOT EXISTS {};".format(self.schema)
             self.ddl = [ddl]
@@ -140,9 +180,8 @@ class Domain:
                 self.ddl.append(ddl)
                 self.common_ddl.append(ddl)
         tables = self.spec[self.domain]["tables"]
-        nodes = {t: tables[t] for t in tables}
-        for node in nodes:
-            self.ddl_for_node((node, nodes[node]))
+        for name, node in tables.items():
+            self.ddl_for_node((name, node))
         return
 
     def list_columns(self, table) -> list:
@@ -207,14 +246,39 @@ class Domain:
         return s
 
     def fqn(self, table):
-        if self.schema:
-            return self.schema + '.' + table
-        return table
+        if table not in self._fqn_cache:
+            if self.schema:
+                self._fqn_cache[table] = self.schema + '.' + table
+            else:
+                self._fqn_cache[table] = table
+        return self._fqn_cache[table]
+
+    def _build_find_index(self) -> Dict[str, dict]:
+        """
+        Walks the whole tree of tables in the domain once and builds
+        a flat index of table definitions by table name. The walk
+        order matches the one used by the recursive search, so for
+        duplicate names the same definition is found.
+
+        :return: a dictionary mapping table names to their definitions
+        """
+        index = dict()
+        stack = [self.spec[self.domain]["tables"]]
+        while stack:
+            tables = stack.pop()
+            for t in tables:
+                index.setdefault(t, tables[t])
+            for t in reversed(list(tables)):
+                if "children" in tables[t]:
+                    stack.append(tables[t]["children"])
+        return index
 
     def find(self, table: str, root = None) -> Optional[dict]:
         if not root:
-            tables = self.spec[self.domain]["tables"]
-        elif "children" in root:
+            if self._find_cache is None:
+                self._find_cache = self._build_find_index()
+            return self._find_cache.get(table)
+        if "children" in root:
             tables = root["children"]
         else:
             return None
@@ -230,27 +294,36 @@ class Domain:
         t = self.find(table)
         if t is None:
             raise LookupError("Table {} does not exist in domain {}".format(table, self.domain))
-        result = {self.fqn(table): self.find(table)}
-        if "children" in t:
-            for child in t["children"]:
-                result.update(self.find_dependent(child))
-        t2 = self.spillover_table(table, t)
-        if t2:
-            result[t2] = ""
+        result = dict()
+        stack = [(table, t)]
+        while stack:
+            name, node = stack.pop()
+            result[self.fqn(name)] = node
+            t2 = self.spillover_table(name, node)
+            if t2:
+                result[t2] = ""
+            if "children" in node:
+                children = node["children"]
+                for child in reversed(list(children)):
+                    stack.append((child, children[child]))
         return result
 
     def drop(self, table, connection) -> list:
         tables = self.find_dependent(table)
+        statements = []
+        for t in tables:
+            obj = tables[t]
+            if "create" in obj:
+                kind = obj["create"]["type"]
+            else:
+                kind = "TABLE"
+            statements.append(
+                "DROP {TABLE} IF EXISTS {} CASCADE;".format(t, TABLE=kind)
+            )
+        sql = "\n".join(statements)
+        logging.info("Executing DDL batch:\n%s", sql)
         with connection.cursor() as cursor:
-            for t in tables:
-                obj = tables[t]
-                if "create" in obj:
-                    kind = obj["create"]["type"]
-                else:
-                    kind = "TABLE"
-                sql = "DROP {TABLE} IF EXISTS {} CASCADE".format(t, TABLE=kind)
-                logging.info(sql)
-                cursor.execute(sql)
+            cursor.execute(sql)
             if not connection.autocommit:
                 connection.commit()
         return [t for t in tables]
@@ -283,8 +356,9 @@ class Domain:
 
     def ddl_for_node(self, node, parent = None) -> None:
         table_basename, definition = node
-        columns = definition.get("columns", [])
-        cnames = {split(column)[0] for column in columns}
+        columns = list(definition.get("columns", []))
+        normalized = [split(column) for column in columns]
+        cnames = {name for name, _ in normalized}
         features = []
         table = self.fqn(table_basename)
         self.ddl_by_table[table] = []
@@ -310,15 +384,21 @@ class Domain:
             fk_column_list = ", ".join(fk_columns)
             fk = "CONSTRAINT {name} FOREIGN KEY ({columns}) REFERENCES {parent} ({columns})"\
                 .format(name=fk_name, columns=fk_column_list, parent=self.fqn(ptable))
+            fk_column_set = set(fk_columns)
             for column in pdef["columns"]:
-                c, _ = split(column)
-                if c in fk_columns and c not in cnames:
+                c, cdef = split(column)
+                if c in fk_column_set and c not in cnames:
                     columns.append(column)
+                    normalized.append((c, cdef))
+                    cnames.add(c)
+            # Publish a new list rather than appending to the one from
+            # the spec: it may be shared with other tables
+            definition["columns"] = columns
 
         if is_view:
             features = [self.view_column_spec(column, definition, table) for column in columns]
         else:
-            features.extend([self.column_spec(column) for column in columns])
+            features.extend([self.column_spec(column) for column in normalized])
 
         pk_columns = None
 
@@ -344,7 +424,7 @@ class Domain:
                 create_table += CREATE_VIEW_GROUP_BY.format(id=group_by, not_null=not_null)
                 reverse_map = {
                     cdef["source"]: c
-                    for c, cdef in [split(column) for column in columns]
+                    for c, cdef in normalized
                     if cdef and "source" in cdef and isinstance(cdef["source"], str)
                 }
                 definition["primary_key"] = [
@@ -366,6 +446,7 @@ class Domain:
                                                            definition,
                                                            features)
                 columns = definition["columns"]
+                normalized = [split(column) for column in columns]
             else:
                 create_table = self.create_true_table(table, features)
         self.append_ddl(table, create_table)
@@ -377,23 +458,23 @@ class Domain:
                 ff = [f for f in features if "CONSTRAINT" not in f and "PRIMARY KEY" not in f]
                 ff.append("REASON VARCHAR(16)")
                 ff.append("recorded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ")
-                create_table = self.create_table(t2) + \
-                    " (\n\t{features}\n);".format(features=",\n\t".join(ff))
+                create_table = self.create_true_table(t2, ff)
                 self.append_ddl(table, create_table)
             self.add_fk_validation(table, pk_columns, action, t2, columns, ptable, fk_columns)
 
         if object_type != "view":
-            for column in columns:
+            table_bn = table.rpartition('.')[2]
+            for column in normalized:
                 if not self.need_index(column):
                     continue
-                ddl, onload = self.get_index_ddl(table, column)
-                if onload:
+                if self.is_required_before_loading(column):
+                    ddl, _ = self._get_index_ddl(table, table_bn, column)
                     self.append_ddl(table, ddl)
                 else:
-                    self.indices.append(ddl)
-                    if table not in self.indices_by_table:
-                        self.indices_by_table[table] = []
-                    self.indices_by_table[table].append(ddl)
+                    self.add_index_spec(
+                        table,
+                        partial(self.column_index_ddl, table, table_bn, column)
+                    )
 
         if "indices" in definition:
             indices = definition["indices"]
@@ -407,9 +488,8 @@ class Domain:
                 self.add_index(table, index, indices[index])
 
         if "children" in definition:
-            children = {t: definition["children"][t] for t in definition["children"]}
-            for child in children:
-                self.ddl_for_node((child, children[child]), parent=node)
+            for child, child_definition in definition["children"].items():
+                self.ddl_for_node((child, child_definition), parent=node)
 
     def create_table_from_view(self, table, definition, features) -> str:
         create = definition["create"]
@@ -433,14 +513,16 @@ class Domain:
         return create_table
 
     def create_true_table(self, table, features) -> str:
-        return self.create_table(table) + " (\n\t{features}\n);".format(
-            features=",\n\t".join(features)
+        return CREATE_TABLE.format(
+            flag = "IF NOT EXISTS" if self.sloppy else "",
+            name = table,
+            features = ",\n\t".join(features)
         )
 
-    def need_index(self, column) -> bool:
+    def need_index(self, column: Tuple[str, dict]) -> bool:
         if self.index_policy == "all":
             return True
-        n, c = split(column)
+        n, c = column
         if "index" in c:
             return True
         if self.index_policy == "selected":
@@ -448,6 +530,11 @@ class Domain:
         return False
 
     def get_index_ddl(self, table, column) -> (str, bool):
+        return self._get_index_ddl(table, table.rpartition('.')[2],
+                                   split(column))
+
+    def _get_index_ddl(self, table: str, table_bn: str,
+                       column: Tuple[str, dict]) -> (str, bool):
         if self.concurrent_indices:
             option = "CONCURRENTLY"
         else:
@@ -456,7 +543,7 @@ class Domain:
         method = None
         iname = None
         onload = False
-        cname, column = split(column)
+        cname, column = column
         if "index" in column:
             index = column["index"]
             if isinstance(index, str) and index != 'true':
@@ -470,12 +557,12 @@ class Domain:
                     onload = True
         if method:
             pass
-        elif self.is_array(column):
+        elif self.column_flags(column)[0]:
             method = "GIN"
         else:
             method = "BTREE"
         if not iname:
-            iname = INDEX_NAME_PATTERN.format(table = table.split('.')[-1], column = cname)
+            iname = INDEX_NAME_PATTERN.format(table = table_bn, column = cname)
         return (INDEX_DDL_PATTERN.format(
             option = option,
             name = iname,
@@ -484,7 +571,17 @@ class Domain:
             method = method
         ), onload)
 
+    def column_index_ddl(self, table: str, table_bn: str,
+                         column: Tuple[str, dict]) -> str:
+        ddl, _ = self._get_index_ddl(table, table_bn, column)
+        return ddl
+
     def add_index(self, table: str, name: str, definition: dict):
+        self.add_index_spec(
+            table, partial(self.named_index_ddl, table, name, definition)
+        )
+
+    def named_index_ddl(self, table: str, name: str, definition: dict) -> str:
         if self.concurrent_indices:
             option = "CONCURRENTLY"
         else:
@@ -496,17 +593,74 @@ class Domain:
             method = "BTREE"
         columns = ','.join(definition["columns"])
         ddl = INDEX_DDL_PATTERN.format(
-            name = INDEX_NAME_PATTERN.format(table = table.split('.')[-1],
+            name = INDEX_NAME_PATTERN.format(table = table.rpartition('.')[2],
                                              column = name),
             option = option,
             table = table,
             column = columns,
             method = method
         )
-        self.indices.append(ddl)
-        if table not in self.indices_by_table:
-            self.indices_by_table[table] = []
-        self.indices_by_table[table].append(ddl)
+        return ddl
+
+    def add_index_spec(self, table: str, ddl: Callable[[], str]):
+        """
+        Registers an index that is built after the data is loaded.
+        DDL for such indices is only generated when
+        `indices` or `indices_by_table` is first accessed
+
+        :param table: fully qualified name of the indexed table
+        :param ddl: a callable returning DDL for the index
+        """
+        self._index_specs.append((table, ddl))
+        self._indices = None
+        self._indices_by_table = None
+
+    def _materialize_indices(self):
+        self._indices = []
+        self._indices_by_table = dict()
+        for table, ddl in self._index_specs:
+            index = ddl()
+            self._indices.append(index)
+            if table not in self._indices_by_table:
+                self._indices_by_table[table] = []
+            self._indices_by_table[table].append(index)
+
+    @property
+    def indices(self) -> List[str]:
+        if self._indices is None:
+            self._materialize_indices()
+        return self._indices
+
+    @property
+    def indices_by_table(self) -> Dict[str, List[str]]:
+        if self._indices_by_table is None:
+            self._materialize_indices()
+        return self._indices_by_table
+
+    @staticmethod
+    def is_required_before_loading(column: Tuple[str, dict]) -> bool:
+        _, column = column
+        index = column.get("index")
+        return isinstance(index, dict) \
+            and "required_before_loading_data" in index
+
+    def column_flags(self, column: dict) -> Tuple[bool, bool]:
+        """
+        Returns results of `is_array` and `is_generated` for a column
+        definition, memoized until the next call to `init()`.
+        The definition itself is kept in the cache, so that its id
+        cannot be reused by another object while the entry exists
+
+        :param column: column definition
+        :return: a tuple (is_array, is_generated)
+        """
+        key = id(column)
+        if key not in self._col_flag_cache:
+            self._col_flag_cache[key] = (
+                column, self.is_array(column), self.is_generated(column)
+            )
+        _, is_array, is_generated = self._col_flag_cache[key]
+        return is_array, is_generated
 
     @staticmethod
     def is_array(column) -> bool:
@@ -537,10 +691,10 @@ class Domain:
             expression = expression.replace(n, "{}.{}".format(qualifier, n))
         return expression
 
-    def column_spec(self, column) -> str:
-        name, column = split(column)
+    def column_spec(self, column: Tuple[str, dict]) -> str:
+        name, column = column
         t = column.get("type", "VARCHAR")
-        if self.is_generated(column):
+        if self.column_flags(column)[1]:
             if not "code" in column["source"]:
                 raise Exception("Generated column must specify the compute code")
             code = column["source"]["code"]
@@ -612,16 +766,29 @@ class Domain:
                 identifiers.append(name)
         return identifiers
 
+    def match_patterns(self, list_of_tables):
+        key = (tuple(list_of_tables), self.sloppy)
+        if key not in self._match_patterns:
+            tables = [re.escape(t) for t in list_of_tables]
+            creates = [re.escape(self.create_table(t)) for t in list_of_tables]
+            self._match_patterns[key] = (
+                re.compile("(?:{})".format('|'.join(creates))),
+                re.compile(
+                    "(?:CREATE TRIGGER|CREATE OR REPLACE FUNCTION).*(?:{})"
+                    .format('|'.join(tables)),
+                    re.S
+                )
+            )
+        return self._match_patterns[key]
+
     def matches(self, create_statement, list_of_tables) -> bool:
+        if not list_of_tables:
+            return False
         create_statement = create_statement.strip()
-        for t in list_of_tables:
-            if create_statement.startswith(self.create_table(t)):
-                return True
-            for create in ["CREATE TRIGGER", "CREATE OR REPLACE FUNCTION"]:
-                if create_statement.startswith(create) and t in create_statement:
-                    return True
-
-        return False
+        table_pattern, code_pattern = self.match_patterns(list_of_tables)
+        if table_pattern.match(create_statement):
+            return True
+        return code_pattern.match(create_statement) is not None
 
     def create(self, connection, list_of_tables = None):
         with connection.cursor() as cursor:
@@ -634,40 +801,62 @@ class Domain:
                 # ]
             else:
                 statements = self.ddl
-            for statement in statements:
-                logging.info(statement)
             sql = "\n".join(statements)
+            logging.info("Executing DDL batch:\n%s", sql)
             cursor.execute(sql)
             if not connection.autocommit:
                 connection.commit()
             logging.info("Schema and all tables for domain {} have been created".format(self.domain))
 
     def add_fk_validation(self, table, pk, action, target, columns, pt, fk_columns):
-        columns_as_dict = {}
-        for c in columns:
-            name, definition = split(c)
-            columns_as_dict[name] = definition
+        if action not in ["insert", "ignore"]:
+            raise Exception("Invalid action on validation for table {}: {}".format(table, action))
+        normalized = [split(c) for c in columns]
+        # Sibling tables often share the same shape of keys and columns,
+        # and hence produce identical conditions and actions
+        shape = tuple(
+            (name, definition["source"].get("code")
+                if self.column_flags(definition)[1] else None)
+            for name, definition in normalized
+        )
+        key = (action, target, tuple(pk), tuple(fk_columns), shape)
+        if key not in self._fk_validation_cache:
+            self._fk_validation_cache[key] = self.fk_validation_clauses(
+                pk, action, target, columns, normalized, fk_columns
+            )
+        conditions, actions = self._fk_validation_cache[key]
+        t = basename(table)
+
+        sql = VALIDATION_PROC.format(schema=self.schema, source=t, parent_table=self.fqn(pt),
+                                     condition_dup = conditions[0], action_dup = actions[0],
+                                     condition_fk = conditions[1], action_fk = actions[1],
+                                     condition_pk = conditions[2], action_pk = actions[2],
+        )
+        self.append_ddl(table, sql)
+        sql = VALIDATION_TRIGGER.format(schema=self.schema, name=t, table=table).strip()
+        self.append_ddl(table, sql)
+
+    def fk_validation_clauses(self, pk, action, target, columns, normalized,
+                              fk_columns) -> Tuple[List[str], List[str]]:
+        columns_as_dict = dict(normalized)
         if action == "insert":
-            cc = []
-            for c in columns:
-                name, definition = split(c)
-                if not self.is_generated(definition):
-                    cc.append(name)
+            cc = [
+                name for name, definition in normalized
+                if not self.column_flags(definition)[1]
+            ]
             vv = ["NEW.{}".format(c) for c in cc]
             actions = [
                 AUDIT_INSERT.format(target=target, columns=','.join(cc), values=','.join(vv), reason=r)
                 for r in ["DUPLICATE", "FOREIGN KEY", "PRIMARY KEY"]
             ]
-        elif action == "ignore":
-            actions = ["", "", ""]
         else:
-            raise Exception("Invalid action on validation for table {}: {}".format(table, action))
+            actions = ["", "", ""]
         conditions = []
         for constraint in [pk, fk_columns]:
             cols = []
             for c in constraint:
                 column = columns_as_dict[c]
-                if self.is_generated(column):
+                if self.column_flags(column)[1]:
                     exp = self.extract_generation_code(column, columns, "NEW")
                     cols.append("{exp} = t.{c}".format(exp=exp,c=c))
                 else:
@@ -675,13 +864,4 @@ class Domain:
             conditions.append("\n\t\t\t\tAND ".join(cols))
         conditions.append("\n\t\t\t\tOR ".join(["NEW.{c} IS NULL ".format(c=c) for c in pk]))
         # OR NEW.{c} = ''
-        t = basename(table)
-
-        sql = VALIDATION_PROC.format(schema=self.schema, source=t, parent_table=self.fqn(pt),
-                                     condition_dup = conditions[0], action_dup = actions[0],
-                                     condition_fk = conditions[1], action_fk = actions[1],
-                                     condition_pk = conditions[2], action_pk = actions[2],
-        )
-        self.append_ddl(table, sql)
-        sql = VALIDATION_TRIGGER.format(schema=self.schema, name=t, table=table).strip()
-        self.append_ddl(table, sql)
+        return conditions, actions
@@ -17,9 +17,14 @@
 #  limitations under the License.
 #
 
+import io
 import os
 
 import yaml
+try:
+    from yaml import CSafeDumper as Dumper
+except ImportError:
+    from yaml import SafeDumper as Dumper
 
 from nsaph.md import parse
 from nsaph.data_model.model import Table
@@ -48,28 +53,32 @@ def create(table: Table, readme: str = None):
     else:
         cds = {}
 
-    for i in range(0, len(table.sql_columns)):
-        c = table.sql_columns[i]
-        type = table.types[i]
-        c1 = table.csv_columns[i]
-        if c1 in cds:
-            desc = cds[c1]
-        elif c != c1:
-            desc = "'{}'".format(c1)
-        else:
-            desc = None
-        column = {
+    t["columns"] = [
+        {
             "column_name": c,
             "type": type,
-            "description": desc
+            "description": cds[c1] if c1 in cds
+                else ("'{}'".format(c1) if c != c1 else None)
         }
-        t["columns"].append(column)
+        for c, type, c1
+        in zip(table.sql_columns, table.types, table.csv_columns)
+    ]
     return ds
 
 
 def write(ds, out_path: str):
-    with open (out_path, "w") as o:
-        yaml.dump(ds, o, sort_keys=True)
+    buffer = io.StringIO()
+    yaml.dump(ds, buffer, Dumper=Dumper, sort_keys=True,
+              default_flow_style=False)
+    tmp = out_path + ".tmp"
+    try:
+        with open (tmp, "w") as o:
+            o.write(buffer.getvalue())
+        os.replace(tmp, out_path)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
 
 
 def create_datasource_def(t: Table, readme: str, out_dir: str):